@@ -1,5 +1,26 @@
 from .models import *
+from .util import PUP_FIELDS
+import re
+from collections import OrderedDict
 import pandas as pd
+import numpy as np
+import scipy.signal as signal
+
+try:
+    from numba import njit as _njit
+    _HAS_NUMBA = True
+except ImportError:
+    # numba is optional - without it the kernels below run as plain python
+    _HAS_NUMBA = False
+
+    def _njit(*args, **kwargs):
+        return lambda f: f
+
+# from pandas 1.5 on, df[col] = values always replaces the column. before
+# that it may write into a block shared with a shallow copy's source, so
+# masking has to fall back on a deep copy there.
+_SETITEM_REPLACES = tuple(int(v) for v in
+                          re.match(r"(\d+)\.(\d+)", pd.__version__).groups()) >= (1, 5)
 
 #-------------------------------------------------------------
 # Masking
@@ -27,43 +48,37 @@ def find_nested_events(samples, outer, inner):
     # looking for inner events whose onset is at or before outer offset,
     # and whose offset is at or after inner onset.
     # get list of onsets of first samples *after* inner events
-    onsets = inner.index.to_series()
-    post_onsets = onsets + inner.duration
+    onsets = inner.index.values.astype(np.int64)
+    post_onsets = onsets + inner.duration.values.astype(np.int64)
     # convert to list of positional indices
-    max_onset = samples.index[-1]
-    last_idxs = post_onsets.apply(lambda x: max(
-        0, samples.index.searchsorted(x, side="right") - 1))
+    sidx = samples.index.values
+    max_onset = sidx[-1]
+    last_idxs = np.maximum(
+        0, np.searchsorted(sidx, post_onsets, side="right") - 1)
     # step back by one positional index to get pos. index of last samples of our events.
     # stupid fix - don't nudge the index back for events whose duration went beyond the samples
     end_safe_evs = post_onsets <= max_onset
-    last_idxs[end_safe_evs] = last_idxs[end_safe_evs] - 1
+    last_idxs[end_safe_evs] -= 1
+    # ...and don't let events ending on the first sample wrap around to the last
+    last_idxs = np.maximum(0, last_idxs)
     # get the time indices of the last samples of our events
-    last_onsets = last_idxs.apply(lambda x: samples.index[x])
-    idxs = outer.apply(has_overlapping_events, axis=1,
-                       args=[onsets, last_onsets])
-    if len(idxs) == 0:
+    last_onsets = sidx[last_idxs]
+    if len(outer) == 0:
         return pd.DataFrame()
-    return outer[idxs]
-
-
-def has_overlapping_events(event, onsets, last_onsets):
-    """ Searches for onset/last_onset pairs overlapping with the event in 'event.'
-
-    Specifically, searches series last_onsets for rows with onset <= event
-    offset, and offset >= event onset.
-
-    Parameters
-    ----------
-    event (1xN DataFrame)
-        The event you're testing for intersection with the onsets/last_onsets.
-    onsets (numpy array like)
-        Onset indices of potentially intersecting events.
-    last_onsets (numpy array like)
-        Last indices of the potentially intersecting events.
-    """
-    matches = last_onsets[(onsets <= event.name +
-                           event.duration) & (last_onsets >= event.name)]
-    return len(matches) > 0
+    # sweep over the inner events in onset order. an outer event contains an
+    # inner event iff some inner event with onset <= outer offset has a last
+    # onset >= outer onset, so we only need the running max of last onsets.
+    # (pd.IntervalIndex.get_indexer only does point lookups and refuses
+    # overlapping intervals, so it can't stand in for this.)
+    order = np.argsort(onsets, kind="mergesort")
+    onsets_sorted = onsets[order]
+    max_last_onsets = np.maximum.accumulate(last_onsets[order])
+    outer_onsets = outer.index.values
+    outer_offsets = outer_onsets + outer.duration.values
+    n_before = np.searchsorted(onsets_sorted, outer_offsets, side="right")
+    idxs = n_before > 0
+    idxs[idxs] = max_last_onsets[n_before[idxs] - 1] >= outer_onsets[idxs]
+    return outer.iloc[idxs]
 
 
 def get_eyelink_mask_events(samples, events, find_recovery=True):
@@ -84,9 +99,15 @@ def get_eyelink_mask_events(samples, events, find_recovery=True):
         Defaul True. If true, we will use adjust_eyelink_recov_idxs to find
         the proper ends for blink events.
     """
-    be = events.EBLINK.duration.to_frame()
-    be = pd.concat([be, find_nested_events(
-        samples, events.ESACC.duration.to_frame(), be)])
+    blinks = events.EBLINK
+    saccs = find_nested_events(samples, events.ESACC, blinks)
+    onsets = [blinks.index.values]
+    durs = [blinks.duration.values]
+    if len(saccs) > 0:
+        onsets.append(saccs.index.values)
+        durs.append(saccs.duration.values)
+    be = pd.DataFrame({"duration": np.concatenate(durs)},
+                      index=pd.Index(np.concatenate(onsets), name=blinks.index.name))
     if find_recovery:
         adjust_eyelink_recov_idxs(samples, be)
     return be
@@ -122,9 +143,15 @@ def mask_eyelink_blinks(samples, events, mask_fields=["pup_l"], find_recovery=Tr
         Defaul True. If true, we will use adjust_eyelink_recov_idxs to find
         the proper ends for blink events.
     """
-    samps = samples.copy(deep=True)
-    indices = get_eyelink_mask_idxs(samps, events, find_recovery=find_recovery)
-    samps.loc[indices, mask_fields] = float('nan')
+    # only the masked columns get copied - the rest is shared with 'samples'
+    # (unless pandas is too old for that to be safe)
+    samps = samples.copy(deep=not _SETITEM_REPLACES)
+    indices = get_eyelink_mask_idxs(samples, events, find_recovery=find_recovery)
+    rows = np.isin(samples.index.values, indices)
+    for f in mask_fields:
+        col = samples[f].values.astype(np.float64)
+        col[rows] = np.nan
+        samps[f] = col
     return samps
 
 
@@ -138,9 +165,13 @@ def mask_zeros(samples, mask_fields=["pup_l"]):
     mask_fields (list of strings)
         The columns in you'd like to search for 0 values.
     """
-    samps = samples.copy(deep=True)
-    for f in mask_fields:
-        samps[samps[f] == 0] = float("nan")
+    # only the masked columns get copied - the rest is shared with 'samples'
+    # (unless pandas is too old for that to be safe)
+    samps = samples.copy(deep=not _SETITEM_REPLACES)
+    block = samples[mask_fields].values.astype(np.float64)
+    block[block == 0] = np.nan
+    for i, f in enumerate(mask_fields):
+        samps[f] = block[:, i]
     return samps
 
 
@@ -155,11 +186,8 @@ def interp_zeros(samples, interp_fields=["pup_l"]):
         The column names from samples in which you'd like to replace 0s.
     """
     samps = mask_zeros(samples, mask_fields=interp_fields)
-    samps = samps.interpolate(method="linear", axis=0, inplace=False)
-    # since interpolate doesn't handle the start/finish, bfill the ffill to
-    # take care of NaN's at the start/finish samps.
-    samps.fillna(method="bfill", inplace=True)
-    samps.fillna(method="ffill", inplace=True)
+    # mask_zeros gave us fresh copies of interp_fields, so fill them in place
+    _interp_nans(samps, interp_fields)
     return samps
 
 
@@ -185,12 +213,33 @@ def interp_eyelink_blinks(samples, events, find_recovery=True, interp_fields=["p
     """
     samps = mask_eyelink_blinks(
         samples, events, mask_fields=interp_fields, find_recovery=find_recovery)
-    # inplace=True causes a crash, so for now...
-    # fixed by #6284 ; will be in 0.14 release of pandas
-    samps = samps.interpolate(method="linear", axis=0, inplace=True)
+    # mask_eyelink_blinks gave us fresh copies of interp_fields, so fill them
+    # in place
+    _interp_nans(samps, interp_fields)
     return samps
 
 
+def _interp_nans(samps, fields):
+    """ Replaces NaNs in samps' fields with linearly interpolated data.
+
+    Works column by column with np.interp, so only the given fields are
+    touched. NaNs at the start/finish take the first/last valid value.
+    Columns are filled in place (unless pandas hands back read-only arrays),
+    so samps must not share them with anyone else.
+    """
+    for f in fields:
+        col = samps[f].values
+        nans = np.isnan(col)
+        if not nans.any() or nans.all():
+            continue
+        col = col.astype(np.float64, copy=False)
+        if not col.flags.writeable:
+            col = col.copy()
+        good = np.flatnonzero(~nans)
+        col[nans] = np.interp(np.flatnonzero(nans), good, col[good])
+        samps[f] = col
+
+
 def ev_row_idxs(samples, events):
     """ Returns the indices in 'samples' contained in events from 'events.'
 
@@ -201,13 +250,26 @@ def ev_row_idxs(samples, events):
     events (cili Events)
         The events whose indices you'd like to pull from 'samples.'
     """
-    import numpy as np
-    idxs = []
-    for idx, dur in list(events.duration.items()):
-        idxs.extend(list(range(idx, int(idx + dur))))
-    idxs = np.unique(idxs)
-    idxs = np.intersect1d(idxs, samples.index.tolist())
-    return idxs
+    starts = events.index.values.astype(np.int64)
+    ends = (events.index.values + events.duration.values).astype(np.int64)
+    order = np.argsort(starts, kind="mergesort")
+    starts, ends = starts[order], ends[order]
+    # clip each event's start to the furthest end seen so far, so that the
+    # remaining ranges are disjoint and already in order - no need to sort
+    # and dedupe the result.
+    prev_ends = np.maximum.accumulate(ends)
+    starts[1:] = np.maximum(starts[1:], prev_ends[:-1])
+    counts = np.maximum(ends - starts, 0)
+    total = int(counts.sum())
+    offsets = np.cumsum(counts) - counts
+    idxs = np.arange(total, dtype=np.int64) + np.repeat(starts - offsets, counts)
+    # keep only the indices that are actually present in samples
+    sidx = samples.index.values
+    if len(sidx) == 0:
+        return idxs[:0]
+    pos = np.searchsorted(sidx, idxs, side="left")
+    in_samples = sidx[np.minimum(pos, len(sidx) - 1)] == idxs
+    return idxs[in_samples]
 
 
 def adjust_eyelink_recov_idxs(samples, events, z_thresh=.1, window=1000, kernel_size=100):
@@ -235,36 +297,149 @@ def adjust_eyelink_recov_idxs(samples, events, z_thresh=.1, window=1000, kernel_
         n='kernel' indices after it, then z-scored, is below the given z
         threshold.
     """
-    import numpy as np
-    from .util import PUP_FIELDS
     # find a pupil size field to use
     p_fields = [f for f in samples.columns if f in PUP_FIELDS]
     if len(p_fields) == 0:
         return  # if we can't find a pupil field, we won't make any adjustments
     field = p_fields[0]
-    # use pandas to take rolling mean. pandas' kernel looks backwards, so we need to pull a reverse...
-    dfs = np.gradient(samples[field].values)
-    reversed_dfs = dfs[::-1]
-    reversed_dfs_ravg = np.array(pd.Series(reversed_dfs).rolling(window=kernel_size).mean())
-    dfs_ravg = reversed_dfs_ravg[::-1]
-    dfs_ravg = np.abs((dfs_ravg - np.mean(dfs_ravg)) / np.std(dfs_ravg))
-    samp_count = len(samples)
+    vals = np.ascontiguousarray(samples[field].values, dtype=np.float64)
+    if _HAS_NUMBA:
+        dfs_ravg = _gradient_ravg_zscore(vals, kernel_size)
+    else:
+        # a per-sample python loop is far too slow, so stick to numpy
+        dfs_ravg = _gradient_ravg_zscore_np(vals, kernel_size)
     # search for drop beneath z_thresh after end index
-    new_durs = []
-    for idx, dur in list(events.duration.items()):
-        try:
-            s_pos = samples.index.get_loc(idx + dur) - 1
-            e_pos = samples.index[min(s_pos + window, samp_count - 1)]
-        except Exception as e:
-            # can't do much about that
-            s_pos = e_pos = 0
-        if s_pos == e_pos:
-            new_durs.append(dur)
+    sidx = np.ascontiguousarray(samples.index.values, dtype=np.int64)
+    starts = np.ascontiguousarray(events.index.values, dtype=np.int64)
+    durs = np.ascontiguousarray(events.duration.values, dtype=np.int64)
+    events.duration = _recov_durs(dfs_ravg, sidx, starts, durs, z_thresh, window)
+
+
+@_njit(cache=True)
+def _gradient_at(vals, i):
+    """ Returns np.gradient(vals)[i] without computing the whole gradient """
+    if i == 0:
+        return vals[1] - vals[0]
+    if i == len(vals) - 1:
+        return vals[i] - vals[i - 1]
+    return (vals[i + 1] - vals[i - 1]) / 2.
+
+
+@_njit(cache=True)
+def _gradient_ravg_zscore(vals, kernel_size):
+    """ Returns the absolute z-scored forward rolling mean of vals' gradient
+
+    Equivalent to taking np.gradient, averaging each gradient value with the
+    kernel_size - 1 values after it (NaN where fewer remain), then z-scoring
+    against the mean/std of the non-NaN averages, but fused into two passes
+    with a single output allocation. See adjust_eyelink_recov_idxs FMI.
+    """
+    samp_count = len(vals)
+    out = np.empty(samp_count, dtype=np.float64)
+    if samp_count < 2:
+        out[:] = np.nan
+        return out
+    # walk backwards so the trailing running sum gives a forward-looking mean
+    rsum = 0.
+    nan_count = 0
+    mu = 0.
+    m2 = 0.
+    n = 0
+    for i in range(samp_count - 1, -1, -1):
+        g = _gradient_at(vals, i)
+        if np.isnan(g):
+            nan_count += 1
+        else:
+            rsum += g
+        if i + kernel_size < samp_count:
+            g_old = _gradient_at(vals, i + kernel_size)
+            if np.isnan(g_old):
+                nan_count -= 1
+            else:
+                rsum -= g_old
+        if i + kernel_size > samp_count or nan_count > 0:
+            out[i] = np.nan
+            continue
+        ravg = rsum / kernel_size
+        out[i] = ravg
+        # welford's running mean/variance, skipping NaNs
+        n += 1
+        delta = ravg - mu
+        mu += delta / n
+        m2 += delta * (ravg - mu)
+    sigma = np.sqrt(m2 / n) if n > 0 else 0.
+    if sigma == 0:
+        # nothing to z-score against (e.g. a flat trace)
+        out[:] = np.nan
+        return out
+    for i in range(samp_count):
+        out[i] = abs((out[i] - mu) / sigma)
+    return out
+
+
+def _gradient_ravg_zscore_np(vals, kernel_size):
+    """ Numpy version of _gradient_ravg_zscore, for when numba isn't around """
+    samp_count = len(vals)
+    if samp_count < 2:
+        return np.full(samp_count, np.nan)
+    dfs = np.gradient(vals)
+    # take the forward-looking mean from differences of a cumulative sum,
+    # indexed from the front so nothing needs reversing. NaN wherever the
+    # window holds a NaN or runs off the end.
+    nans = np.isnan(dfs)
+    csum = np.concatenate(([0.], np.cumsum(np.where(nans, 0., dfs))))
+    ncount = np.concatenate(([0], np.cumsum(nans)))
+    dfs_ravg = np.full(samp_count, np.nan)
+    if kernel_size <= samp_count:
+        wsum = csum[kernel_size:] - csum[:-kernel_size]
+        wsum[ncount[kernel_size:] - ncount[:-kernel_size] > 0] = np.nan
+        dfs_ravg[:samp_count - kernel_size + 1] = wsum / kernel_size
+    if np.isnan(dfs_ravg).all():
+        return dfs_ravg
+    mu = np.nanmean(dfs_ravg)
+    sigma = np.sqrt(np.nanmean((dfs_ravg - mu) ** 2))
+    if sigma == 0:
+        # nothing to z-score against (e.g. a flat trace)
+        return np.full(samp_count, np.nan)
+    return np.abs((dfs_ravg - mu) / sigma)
+
+
+@_njit(cache=True)
+def _recov_durs(dfs_ravg, sidx, starts, durs, z_thresh, window):
+    """ Returns event durations pushed out to where dfs_ravg drops below z_thresh
+
+    Works on raw ndarrays so it can be compiled by numba. See
+    adjust_eyelink_recov_idxs FMI.
+    """
+    samp_count = len(sidx)
+    new_durs = durs.copy()
+    for i in range(len(starts)):
+        end = starts[i] + durs[i]
+        pos = np.searchsorted(sidx, end)
+        if pos >= samp_count or sidx[pos] != end:
+            continue  # event doesn't end on a sample - can't do much about that
+        s_pos = pos - 1
+        e_pos = min(s_pos + window, samp_count - 1)
+        if s_pos < 0 or s_pos >= e_pos:
             continue
-        e_dpos = np.argmax(dfs_ravg[s_pos:e_pos] < z_thresh)  # 0 if not found
-        new_end = samples.index[min(s_pos + e_dpos, samp_count - 1)]
-        new_durs.append(new_end - idx)
-    events.duration = new_durs
+        e_dpos = _first_below(dfs_ravg, s_pos, e_pos, z_thresh)
+        new_durs[i] = sidx[s_pos + e_dpos] - starts[i]
+    return new_durs
+
+
+if _HAS_NUMBA:
+    @_njit(cache=True)
+    def _first_below(vals, start, stop, thresh):
+        """ Returns offset from start of the first value below thresh, 0 if none """
+        for k in range(stop - start):
+            if vals[start + k] < thresh:
+                return k
+        return 0
+else:
+    def _first_below(vals, start, stop, thresh):
+        """ Returns offset from start of the first value below thresh, 0 if none """
+        hits = np.flatnonzero(vals[start:stop] < thresh)
+        return hits[0] if len(hits) else 0
 
 #-------------------------------------------------------------
 # Filters
@@ -279,10 +454,27 @@ def butterworth_series(samples, fields=["pup_l"], filt_order=5, cutoff_freq=.01,
     # and cutoff_freq manually. In the future, it would be nice to use
     # signal.buttord (heh) to let people adjust in terms of dB loss and
     # attenuation.
-    import scipy.signal as signal
-    from numpy import array
     samps = samples if inplace else samples.copy(deep=True)
-    B, A = signal.butter(filt_order, cutoff_freq, output="BA")
-    samps[fields] = samps[fields].apply(
-        lambda x: signal.filtfilt(B, A, x), axis=0)
+    sos = _butter_sos(filt_order, cutoff_freq)
+    samps[fields] = signal.sosfiltfilt(sos, samps[fields].values, axis=0)
     return samps
+
+
+_BUTTER_SOS_CACHE = OrderedDict()
+_BUTTER_SOS_CACHE_SIZE = 32
+
+
+def _butter_sos(filt_order, cutoff_freq):
+    """ Returns (cached) second-order sections for a butterworth filter
+
+    Keeps the _BUTTER_SOS_CACHE_SIZE most recently used filters.
+    """
+    key = (filt_order, tuple(np.atleast_1d(cutoff_freq)))
+    sos = _BUTTER_SOS_CACHE.pop(key, None)
+    if sos is None:
+        sos = signal.butter(filt_order, cutoff_freq, output="sos")
+        if len(_BUTTER_SOS_CACHE) >= _BUTTER_SOS_CACHE_SIZE:
+            _BUTTER_SOS_CACHE.popitem(last=False)
+    # (re)insert as the most recently used
+    _BUTTER_SOS_CACHE[key] = sos
+    return sos
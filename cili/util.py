@@ -446,7 +446,7 @@ def constrain_events(samples, events):
     for en in enames:
         df = events.dframes[en]
         idxs = np.where(df.index < lowtime)[0]
-        new_idxs = np.array(df.index.tolist())
+        new_idxs = df.index.values.copy()
         new_idxs[idxs] = lowtime
         df.index = new_idxs
 
@@ -0,0 +1,151 @@
+import numpy as np
+import pandas as pd
+from numpy.testing import assert_array_equal, assert_allclose
+from nose.tools import assert_equal, assert_true
+
+from tests.config import *
+from cili.util import pandas_dfs_from_asc
+from cili.cleanup import *
+from cili.cleanup import _gradient_ravg_zscore, _gradient_ravg_zscore_np
+
+# Unit tests for the cleanup module. Paths to data files assume tests
+# are run from the /cili/ directory.
+
+
+def zeros_samples():
+    """ A few samples with zeros in both the pupil and an unrelated column """
+    return pd.DataFrame({'pup_l': [0., 5., 0., 7., 0.],
+                         'x_l': [0., 1., 2., 0., 4.]}, index=np.arange(5) * 2)
+
+
+""" find_nested_events """
+
+
+def test_find_nested_events():
+    ds = pd.DataFrame(index=np.arange(0, 100, 2))
+    # the first two outer events overlap each other; 90 runs past the end
+    outer = pd.DataFrame({'duration': [20, 20, 10, 20, 5]},
+                         index=[10, 20, 50, 90, 70])
+    # 32 sits in 20 only, 26 in both 10 and 20, 95 runs past the last
+    # sample, and -10 ends on the first sample so it overlaps nothing
+    inner = pd.DataFrame({'duration': [4, 20, 10, 2]}, index=[32, 95, -10, 26])
+    nested = find_nested_events(ds, outer, inner)
+    assert_array_equal(nested.index.values, [10, 20, 90])
+    assert_array_equal(nested.duration.values, [20, 20, 20])
+    nested = find_nested_events(ds, outer, inner.iloc[:0])
+    assert_equal(len(nested), 0)
+
+
+""" ev_row_idxs """
+
+
+def test_ev_row_idxs():
+    # samples with gaps at 5-9 and 13-19
+    ds = pd.DataFrame(index=[0, 1, 2, 3, 4, 10, 11, 12, 20])
+    # out of order, nested (1 in 0), touching (2 at the end of 0),
+    # overlapping (3 with 2) and running into a gap, zero length (8), ends
+    # exclusive (11 doesn't reach 12), past the last sample (19) and
+    # entirely in a gap (15)
+    events = pd.DataFrame({'duration': [1, 2, 1, 2, 4, 0, 5, 2]},
+                          index=[11, 0, 1, 2, 3, 8, 19, 15])
+    assert_array_equal(ev_row_idxs(ds, events), [0, 1, 2, 3, 4, 11, 20])
+    assert_equal(len(ev_row_idxs(ds, events.iloc[:0])), 0)
+
+
+""" adjust_eyelink_recov_idxs """
+
+
+def test_recovery_durations_monoRemote500():
+    # blinks, then the saccades that contain them
+    ds, es = pandas_dfs_from_asc(paths['monoRemote500'])
+    be = get_eyelink_mask_events(ds, es, find_recovery=False)
+    assert_array_equal(be.duration.values, [56, 24, 22, 196, 152, 150])
+    be = get_eyelink_mask_events(ds, es)
+    assert_array_equal(be.index.values, [12151796, 12169510, 12218674,
+                                         12151724, 12169458, 12218622])
+    assert_array_equal(be.duration.values, [1912, 66, 70, 1984, 152, 148])
+
+
+def test_gradient_ravg_zscore_paths_agree():
+    ds, es = pandas_dfs_from_asc(paths['monoRemote500'])
+    vals = np.ascontiguousarray(ds.pup_l.values, dtype=np.float64)
+    # reference: pandas' trailing rolling mean on the reversed gradient
+    dfs = np.gradient(vals)
+    ravg = np.array(pd.Series(dfs[::-1]).rolling(window=100).mean())[::-1]
+    ref = np.abs((ravg - np.nanmean(ravg)) / np.nanstd(ravg))
+    py_func = getattr(_gradient_ravg_zscore, 'py_func', _gradient_ravg_zscore)
+    for fn in [_gradient_ravg_zscore, py_func, _gradient_ravg_zscore_np]:
+        assert_allclose(fn(vals, 100), ref, rtol=1e-10, atol=1e-12)
+
+
+def test_recovery_flat_signal():
+    # nothing to z-score against, so events end one sample early as before
+    for pup in [np.full(1000, 5.), np.zeros(1000)]:
+        ds = pd.DataFrame({'pup_l': pup}, index=np.arange(1000))
+        events = pd.DataFrame({'duration': [100, 200]}, index=[100, 400])
+        adjust_eyelink_recov_idxs(ds, events)
+        assert_array_equal(events.duration.values, [99, 199])
+        assert_true(np.isnan(_gradient_ravg_zscore(pup, 100)).all())
+        assert_true(np.isnan(_gradient_ravg_zscore_np(pup, 100)).all())
+
+""" mask_zeros """
+
+
+def test_mask_zeros_only_masks_fields():
+    ds = zeros_samples()
+    orig = ds.copy(deep=True)
+    masked = mask_zeros(ds, mask_fields=['pup_l'])
+    assert_array_equal(masked.pup_l.values, [np.nan, 5., np.nan, 7., np.nan])
+    assert_array_equal(masked.x_l.values, [0., 1., 2., 0., 4.])
+    pd.testing.assert_frame_equal(ds, orig)
+
+""" interp_zeros """
+
+
+def test_interp_zeros_only_fills_fields():
+    ds = zeros_samples()
+    orig = ds.copy(deep=True)
+    interped = interp_zeros(ds, interp_fields=['pup_l'])
+    assert_array_equal(interped.pup_l.values, [5., 5., 6., 7., 7.])
+    assert_array_equal(interped.x_l.values, [0., 1., 2., 0., 4.])
+    pd.testing.assert_frame_equal(ds, orig)
+
+""" interp_eyelink_blinks """
+
+
+def test_interp_eyelink_blinks_returns_filled_frame():
+    ds, es = pandas_dfs_from_asc(paths['monoRemote500'])
+    orig = ds.copy(deep=True)
+    interped = interp_eyelink_blinks(ds, es, interp_fields=['pup_l'])
+    assert_true(isinstance(interped, pd.DataFrame))
+    assert_equal(interped.pup_l.isnull().sum(), 0)
+    pd.testing.assert_frame_equal(ds, orig)
+
+""" butterworth_series """
+
+
+def test_butterworth_series_columns():
+    from scipy import signal
+    rng = np.random.RandomState(0)
+    ds = pd.DataFrame({'pup_l': np.cumsum(rng.randn(2000)),
+                       'pup_r': np.cumsum(rng.randn(2000)),
+                       'x_l': rng.randn(2000)})
+    orig = ds.copy(deep=True)
+    filtered = butterworth_series(ds, fields=['pup_l', 'pup_r'])
+    sos = signal.butter(5, .01, output="sos")
+    for f in ['pup_l', 'pup_r']:
+        assert_allclose(filtered[f].values,
+                        signal.sosfiltfilt(sos, ds[f].values))
+    assert_array_equal(filtered.x_l.values, ds.x_l.values)
+    pd.testing.assert_frame_equal(ds, orig)
+
+
+def test_butter_sos_cache_is_bounded():
+    from cili.cleanup import _BUTTER_SOS_CACHE, _BUTTER_SOS_CACHE_SIZE
+    ds = pd.DataFrame({'pup_l': np.random.randn(500)})
+    butterworth_series(ds, cutoff_freq=.01)
+    for i in range(_BUTTER_SOS_CACHE_SIZE * 2):
+        butterworth_series(ds, cutoff_freq=.02 + i * .001)
+        butterworth_series(ds, cutoff_freq=.01)  # keep this one in use
+    assert_equal(len(_BUTTER_SOS_CACHE), _BUTTER_SOS_CACHE_SIZE)
+    assert_true((5, (.01,)) in _BUTTER_SOS_CACHE)